@@ -2,6 +2,8 @@
 ASGI config for main project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests to ``/v1/rates/subscribe/`` are served by the Server-Sent Events app in ``rate.subscriptions``,
+everything else by django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after the django setup, the subscriptions app depends on the models
+from rate.subscriptions import subscribe_app  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"].rstrip("/") == "/v1/rates/subscribe":
+        return await subscribe_app(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -5,5 +5,6 @@ from rate.api import RatesAPI
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('v1/rates/', RatesAPI.as_view())
+    path('v1/rates/', RatesAPI.as_view()),
+    # Note: `v1/rates/subscribe/` (server-sent events) is not a django view, it is routed in main/asgi.py
 ]
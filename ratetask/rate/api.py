@@ -1,3 +1,6 @@
+from datetime import timedelta
+
+from django.db import connection
 from rest_framework.exceptions import NotFound
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
@@ -14,7 +17,15 @@ class RatesAPI(GenericAPIView):
     def get(self, request, *args, **kwargs):
         # validate the query params using the serializer
         params = self.validate_qparams(request.query_params)
+        query = self.average_prices(params)
+
+        data = self.serializer_class(query, many=True).data
+        return Response(data={"results": data}, status=200)
 
+    def average_prices(self, params: dict):
+        """
+        check the origin & destination exist and return the query matching their combination of (port, region)
+        """
         # Note: we assumed that slug is always more than 5 chars.
         if len(params["origin"]) > self.CODE_LEN and len(params["destination"]) > self.CODE_LEN:
             self.region_exists_or_404(params["origin"], params["destination"])
@@ -30,9 +41,7 @@ class RatesAPI(GenericAPIView):
         else:
             self.port_exists_or_404(params["origin"], params["destination"])
             query = self.port2port(params)
-
-        data = self.serializer_class(query, many=True).data
-        return Response(data={"results": data}, status=200)
+        return query
 
     def validate_qparams(self, qparams: dict) -> dict:
         v = RatesListValidator(data=qparams)
@@ -47,51 +56,42 @@ class RatesAPI(GenericAPIView):
         if Port.objects.filter(code__in=args).count() != len(args):
             raise NotFound(detail={"message": "port not found."})
 
-    def port2port(self, params: dict):
+    def ports_of(self, code_or_slug: str) -> set:
+        """
+        return the codes of all ports a `port code` or a `region slug` (including its children) stands for.
+        """
+        if len(code_or_slug) > self.CODE_LEN:
+            self.region_exists_or_404(code_or_slug)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT code FROM ports_in_region(%s)", [code_or_slug])
+                return {row[0] for row in cursor.fetchall()}
+        self.port_exists_or_404(code_or_slug)
+        return {code_or_slug}
+
+    def port2port(self, p: dict):
         """
         return a django_query representing the average price between two ports.
         """
-        q = """
-            WITH cte as (
-                SELECT 1 as id, day, CASE WHEN count(price) >= 3 THEN round(avg(price)) ELSE null END as average_price
-                FROM prices    
-                WHERE orig_code = %s and dest_code = %s
-                GROUP BY day
-            )
-            SELECT 1 as id, generated_day, average_price
-            FROM cte RIGHT OUTER JOIN (
-                select generated_day::date from generate_series(%s::date, %s::date, '1 day'::interval) as generated_day
-            ) as s ON cte.day = s.generated_day
-            ORDER BY generated_day
-        """
-        result = Price.objects.raw(
-            q,
-            params=(params["origin"], params["destination"], params["date_from"], params["date_to"])
-        )
-        return result
+        daily = """
+            SELECT day, sum(price) as total, count(price) as samples
+            FROM prices
+            WHERE orig_code = %(origin)s and dest_code = %(dest)s AND day BETWEEN %(window_start)s AND %(to)s
+            GROUP BY day
+        """
+        return self.rolling_averages(daily, p, origin=p["origin"], dest=p["destination"])
 
     def port2region(self, p: dict):
         """
         return a django query representing the average prices from `origin port` to all ports in `destination` region
         """
-        q = """
-        With result as (
-            SELECT day, CASE WHEN count(price) >= 3 THEN avg(price)::integer ELSE null END as average_price
+        daily = """
+            SELECT day, sum(price) as total, count(price) as samples
             FROM prices
             JOIN ports_in_region(%(slug)s) as all_ports ON dest_code = all_ports.code
-            WHERE orig_code = %(origin)s
+            WHERE orig_code = %(origin)s AND day BETWEEN %(window_start)s AND %(to)s
             GROUP BY day
-            ORDER BY day
-        )
-        select 1 as id, average_price, generated_day FROM result
-        RIGHT OUTER JOIN (
-            select generated_day::date from generate_series(%(from)s::date, %(to)s::date, '1 day'::interval) as generated_day
-        ) as s ON generated_day = day
-        """
-        return Price.objects.raw(
-            q,
-            params={"slug": p["destination"], "origin": p["origin"], "from": p["date_from"], "to": p["date_to"]}
-        )
+        """
+        return self.rolling_averages(daily, p, slug=p["destination"], origin=p["origin"])
 
     def region2port(self, p: dict):
         """
@@ -99,44 +99,60 @@ class RatesAPI(GenericAPIView):
             - origin parameter is a `region slug`
             - destination parameter is a `port code`
         """
-        q = """
-        WITH result as (
-            SELECT day, CASE WHEN count(price) >= 3 THEN avg(price)::integer ELSE null END as average_price
+        daily = """
+            SELECT day, sum(price) as total, count(price) as samples
             FROM prices
             JOIN ports_in_region(%(slug)s) as all_ports ON orig_code = all_ports.code
-            WHERE dest_code = %(dest)s
+            WHERE dest_code = %(dest)s AND day BETWEEN %(window_start)s AND %(to)s
             GROUP BY day
-            ORDER BY day
-        )
-        select 1 as id, average_price, generated_day FROM result
-        RIGHT OUTER JOIN (
-            select generated_day::date from generate_series(%(from)s::date, %(to)s::date, '1 day'::interval) as generated_day
-        ) as s ON generated_day = day        
-                """
-        return Price.objects.raw(
-            q,
-            params={"slug": p["origin"], "dest": p["destination"], "from": p["date_from"], "to": p["date_to"]}
-        )
+        """
+        return self.rolling_averages(daily, p, slug=p["origin"], dest=p["destination"])
 
     def region2region(self, p: dict):
         """
+        generate a query when both origin & destination parameters are `region slug`s
         """
-        q = """
-        WITH result as (
-            SELECT day, CASE WHEN count(price) >= 3 THEN round(avg(price))::integer ELSE null END as average_price
+        daily = """
+            SELECT day, sum(price) as total, count(price) as samples
             FROM prices
             JOIN ports_in_region(%(origin_slug)s) as origin_ports ON prices.orig_code = origin_ports.code
             JOIN ports_in_region(%(dest_slug)s) as destination_ports ON prices.dest_code = destination_ports.code
+            WHERE day BETWEEN %(window_start)s AND %(to)s
             GROUP BY day
-            ORDER BY day
-        )
-        select 1 as id, average_price, generated_day FROM result
-        RIGHT OUTER JOIN (
-            select generated_day::date from generate_series(%(from)s::date, %(to)s::date, '1 day'::interval) as generated_day
-        ) as s ON generated_day = day;
-        """
-        return Price.objects.raw(
-            q,
-            params={"origin_slug": p["origin"], "dest_slug": p["destination"], "from": p["date_from"],
-                    "to": p["date_to"]}
+        """
+        return self.rolling_averages(daily, p, origin_slug=p["origin"], dest_slug=p["destination"])
+
+    def rolling_averages(self, daily: str, p: dict, **query_params):
+        """
+        wrap a `daily` query (day, total, samples) and return a django query representing the average price of the
+        `rolling` days ending at each day between `date_from` and `date_to`. `rolling=1` is the plain daily average.
+
+        The window is sample-weighted (sum of prices / number of prices) and slides over one row per day, so postgres
+        adds the entering day and drops the leaving one instead of re-aggregating N days for every row.
+        The regions are expanded only once, in the `daily` query, no matter how wide the window is.
+        """
+        q = f"""
+        WITH daily as ({daily}),
+        series as (
+            SELECT generated_day::date, coalesce(daily.total, 0) as total, coalesce(daily.samples, 0) as samples
+            FROM generate_series(%(window_start)s::date, %(to)s::date, '1 day'::interval) as generated_day
+            LEFT OUTER JOIN daily ON daily.day = generated_day
+        ),
+        windowed as (
+            SELECT generated_day, sum(total) OVER w as window_total, sum(samples) OVER w as window_samples
+            FROM series
+            WINDOW w AS (ORDER BY generated_day ROWS BETWEEN %(preceding)s PRECEDING AND CURRENT ROW)
         )
+        SELECT 1 as id, generated_day,
+            CASE WHEN window_samples >= 3 THEN round(window_total::numeric / window_samples)::integer ELSE null END
+            as average_price
+        FROM windowed
+        WHERE generated_day >= %(from)s::date
+        ORDER BY generated_day
+        """
+        rolling = p.get("rolling", 1)
+        query_params.update({
+            "from": p["date_from"], "to": p["date_to"],
+            "window_start": p["date_from"] - timedelta(days=rolling - 1), "preceding": rolling - 1,
+        })
+        return Price.objects.raw(q, params=query_params)
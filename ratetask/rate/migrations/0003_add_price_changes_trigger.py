@@ -0,0 +1,15 @@
+from django.db import migrations
+
+from rate.sql_functions import raw__notify_price_changes
+
+
+class Migration(migrations.Migration):
+    dependencies = [("rate", "0002_add_custom_function_nested_regions")]
+
+    operations = [
+        migrations.RunSQL(
+            raw__notify_price_changes,
+            reverse_sql="DROP TRIGGER IF EXISTS prices_notify_changes ON prices; "
+                        "DROP FUNCTION IF EXISTS notify_price_changes();"
+        )
+    ]
@@ -15,6 +15,8 @@ class RatesListValidator(serializers.Serializer):
     date_to = serializers.DateField(required=True, input_formats=["%Y-%m-%d"])
     origin = serializers.CharField(min_length=5, required=True)
     destination = serializers.CharField(min_length=5, required=True)
+    # size (in days) of the moving average window ending at each day. 1 means plain daily averages
+    rolling = serializers.IntegerField(default=1, min_value=1, max_value=60)
 
     def validate(self, params):
         """non-specific field validation"""
@@ -26,3 +28,17 @@ class RatesListValidator(serializers.Serializer):
             raise ValidationError(detail="The allowed interval is 60 days")
 
         return params
+
+
+class LaneSubscriptionValidator(serializers.Serializer):
+    # every lane is "origin:destination", both of them either a port code or a region slug
+    lane = serializers.ListField(child=serializers.CharField(), min_length=1, max_length=20, required=True)
+
+    def validate_lane(self, lanes):
+        # same rules as the origin & destination of `RatesListValidator`
+        code_or_slug = serializers.CharField(min_length=5)
+        result = []
+        for lane in lanes:
+            origin, _, destination = lane.partition(":")
+            result.append((code_or_slug.run_validation(origin), code_or_slug.run_validation(destination)))
+        return list(dict.fromkeys(result))
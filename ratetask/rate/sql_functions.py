@@ -7,3 +7,18 @@ WITH RECURSIVE cte AS (
 )
 select code from ports INNER JOIN cte ON ports.parent_slug = cte.slug
 $$ LANGUAGE SQL;"""
+
+# The `notify_price_changes()` trigger publishes "orig_code|dest_code|day" on the `price_changes` channel for every
+# ingested price. Postgres drops duplicate notifications within a transaction, so a bulk import notifies each
+# (lane, day) only once, after commit.
+PRICE_CHANGES_CHANNEL = "price_changes"
+raw__notify_price_changes = f"""CREATE OR REPLACE function notify_price_changes() returns trigger AS $$
+BEGIN
+    PERFORM pg_notify('{PRICE_CHANGES_CHANNEL}', NEW.orig_code || '|' || NEW.dest_code || '|' || to_char(NEW.day, 'YYYY-MM-DD'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS prices_notify_changes ON prices;
+CREATE TRIGGER prices_notify_changes AFTER INSERT ON prices
+    FOR EACH ROW EXECUTE FUNCTION notify_price_changes();"""
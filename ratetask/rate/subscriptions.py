@@ -0,0 +1,204 @@
+import asyncio
+import json
+from datetime import date
+
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.db import InterfaceError, OperationalError, close_old_connections, connection
+from django.db.models import Max, Min
+from django.http import QueryDict
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from rest_framework.exceptions import APIException
+
+from rate.api import RatesAPI
+from rate.models import Price
+from rate.serializers import LaneSubscriptionValidator, RatesListSerializer
+from rate.sql_functions import PRICE_CHANGES_CHANNEL
+
+# seconds between two sse comments sent to keep idle connections (and proxies in between) open
+KEEP_ALIVE = 15
+
+
+class PriceChangesListener:
+    """
+    LISTEN on the `price_changes` channel using a single connection per process and fan the (orig, dest, day)
+    notifications out to all subscriptions, in the event loop.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.fd = None
+        self.loop = None
+        self.subscriptions = set()
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self, subscription: "LaneSubscription"):
+        async with self.lock:
+            if self.conn is None:
+                self.conn = await sync_to_async(self.connect)()
+                self.fd = self.conn.fileno()
+                self.loop = asyncio.get_running_loop()
+                self.loop.add_reader(self.fd, self.on_notify)
+        self.subscriptions.add(subscription)
+
+    async def unsubscribe(self, subscription: "LaneSubscription"):
+        async with self.lock:
+            self.subscriptions.discard(subscription)
+            # do not keep a postgres backend busy for an idle process
+            if not self.subscriptions:
+                self.close()
+
+    def connect(self):
+        conn = psycopg2.connect(**connection.get_connection_params())
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {PRICE_CHANGES_CHANNEL};")
+        return conn
+
+    def close(self):
+        if self.conn is not None:
+            self.loop.remove_reader(self.fd)
+            self.conn.close()
+            self.conn = None
+
+    def on_notify(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            # the connection is lost (e.g. postgres restarted): end every stream, so the clients reconnect and
+            # the next subscription opens a new connection.
+            self.close()
+            for subscription in self.subscriptions:
+                subscription.close()
+            self.subscriptions.clear()
+            return
+        while self.conn.notifies:
+            orig, dest, day = self.conn.notifies.pop(0).payload.split("|")
+            day = date.fromisoformat(day)
+            for subscription in self.subscriptions:
+                subscription.notify(orig, dest, day)
+
+
+listener = PriceChangesListener()
+
+
+class LaneSubscription:
+    """
+    keep the ports of the subscribed lanes and the last average price sent for every (lane, day), so a client only
+    receives the daily averages which actually changed.
+    """
+
+    def __init__(self, lanes: list):
+        self.api = RatesAPI()
+        # regions are resolved once, on subscription
+        self.lanes = {(o, d): (self.api.ports_of(o), self.api.ports_of(d)) for o, d in lanes}
+        # the non-null daily averages at subscription time, so the first change of a (lane, day) is compared with
+        # what the client could already get from `v1/rates`. A missing (lane, day) means a null average.
+        self.last_sent = {}
+        first_day, last_day = Price.objects.aggregate(Min("day"), Max("day")).values()
+        if first_day is not None:
+            for origin, destination in self.lanes:
+                for day, average in self.daily_averages(origin, destination, first_day, last_day):
+                    if average is not None:
+                        self.last_sent[(origin, destination, day)] = average
+        # (origin, destination, day) waiting to be recomputed; a set, so a bulk import collapses into one entry per
+        # (lane, day) and a slow client cannot grow it without limit
+        self.pending = set()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    @classmethod
+    def from_qparams(cls, qparams: QueryDict) -> "LaneSubscription":
+        v = LaneSubscriptionValidator(data=qparams)
+        v.is_valid(raise_exception=True)
+        return cls(v.validated_data["lane"])
+
+    def notify(self, orig: str, dest: str, day: date):
+        for (origin, destination), (origin_ports, destination_ports) in self.lanes.items():
+            if orig in origin_ports and dest in destination_ports:
+                self.pending.add((origin, destination, day))
+                self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+    def daily_averages(self, origin: str, destination: str, date_from: date, date_to: date) -> list:
+        """(day, average_price) of a lane, exactly as `v1/rates` returns them"""
+        query = self.api.average_prices(
+            {"origin": origin, "destination": destination, "date_from": date_from, "date_to": date_to, "rolling": 1}
+        )
+        return [(date.fromisoformat(r["day"]), r["average_price"]) for r in RatesListSerializer(query, many=True).data]
+
+    def changes(self, pending: set) -> list:
+        """
+        return the daily average of every pending (lane, day) which is different from the last one sent.
+        """
+        events = []
+        for origin, destination, day in sorted(pending):
+            [(_, average)] = self.daily_averages(origin, destination, day, day)
+            key = (origin, destination, day)
+            if self.last_sent.get(key) == average:
+                continue
+            self.last_sent[key] = average
+            events.append({"origin": origin, "destination": destination, "day": day.isoformat(),
+                           "average_price": average})
+        return events
+
+    async def stream(self, send):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), KEEP_ALIVE)
+            except asyncio.TimeoutError:
+                await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+                continue
+            self.wakeup.clear()
+            pending, self.pending = self.pending, set()
+            if not pending:
+                continue
+            try:
+                events = await sync_to_async(self.changes)(pending)
+            except (OperationalError, InterfaceError):
+                # the database connection shared by all streams is lost: drop it, so the next query reconnects,
+                # and end this stream cleanly; the client reconnects and subscribes again.
+                await sync_to_async(close_old_connections)()
+                break
+            for event in events:
+                body = f"event: rate\ndata: {json.dumps(event)}\n\n".encode()
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def subscribe_app(scope, receive, send):
+    """
+    ASGI app streaming (Server-Sent Events) the changed daily averages of the lanes in `?lane=origin:destination`
+    whenever new prices are ingested.
+    """
+    try:
+        subscription = await sync_to_async(LaneSubscription.from_qparams)(QueryDict(scope["query_string"]))
+    except APIException as e:
+        body = json.dumps(e.detail).encode()
+        await send({"type": "http.response.start", "status": e.status_code,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    await listener.subscribe(subscription)
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no"),
+    ]})
+    stream = asyncio.ensure_future(subscription.stream(send))
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({stream, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if stream.done():
+            stream.result()
+    finally:
+        stream.cancel()
+        disconnect.cancel()
+        await listener.unsubscribe(subscription)
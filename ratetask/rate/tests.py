@@ -1,12 +1,27 @@
+import asyncio
+import json
 import random
 from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from unittest import mock
 
-from django.test import TestCase
-from rest_framework.exceptions import ValidationError
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.test import APITestCase
 
+from main.asgi import application
 from rate.api import RatesAPI
 from rate.models import Region, Port, Price
+from rate.subscriptions import LaneSubscription, PriceChangesListener, subscribe_app
+
+
+def pg_round(total: int, count: int) -> int:
+    """round total/count the way postgres rounds a numeric (half away from zero), unlike python's round()"""
+    return int((Decimal(total) / count).quantize(Decimal(1), rounding=ROUND_HALF_UP))
 
 
 class TestRatesQueryParams(TestCase):
@@ -38,6 +53,15 @@ class TestRatesQueryParams(TestCase):
         with self.assertRaises(ValidationError):
             rates_api.validate_qparams(qp)
 
+    def test_rolling_window_size(self):
+        """test the rolling window is optional, defaults to a single day and is bounded"""
+        rates_api = RatesAPI()
+        self.assertEqual(1, rates_api.validate_qparams(self.sample_qp)["rolling"])
+        self.assertEqual(7, rates_api.validate_qparams(dict(self.sample_qp, rolling="7"))["rolling"])
+        for rolling in ["0", "61", "abc"]:
+            with self.assertRaises(ValidationError):
+                rates_api.validate_qparams(dict(self.sample_qp, rolling=rolling))
+
 
 class TestRatesAveragePrice(APITestCase):
     """test if /v1/rates works fine with different combinations of (port, region)"""
@@ -219,3 +243,276 @@ class TestRatesAveragePrice(APITestCase):
             else:
                 expected = round(sum(q) / len(q))
                 self.assertFalse(abs(resp.data["results"][idx]["average_price"] - expected) > 1)
+
+    def test_rolling_average(self):
+        """
+        Test the rolling average is weighted by the number of prices in the window & includes the days before
+        `date_from` which fall into the window.
+        """
+        d = {
+            "date_from": "2023-01-04", "date_to": "2023-01-06",
+            "origin": self.r2.slug, "destination": self.r1.slug, "rolling": 3
+        }
+        resp = self.api.get(path="/v1/rates/", data=d)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(3, len(resp.data["results"]))
+        self.assertEqual(resp.data["results"][0]["day"], "2023-01-04")
+
+        for idx, day in enumerate([date(2023, 1, 4) + timedelta(days=i) for i in range(3)]):
+            q = Price.objects.filter(
+                orig_code__in=self.region2_ports,
+                dest_code__in=self.region1_ports,
+                day__gt=day - timedelta(days=3),
+                day__lte=day,
+            ).values_list("price", flat=True)
+            if len(q) < 3:
+                self.assertIsNone(resp.data["results"][idx]["average_price"])
+            else:
+                self.assertEqual(pg_round(sum(q), len(q)), resp.data["results"][idx]["average_price"])
+
+    def test_rolling_window_looks_back_before_date_from(self):
+        """Test the prices before `date_from` are only included in the days whose window reaches them"""
+        p_30001 = Port.objects.create(code="30001", name="port-30001", parent=self.r2)
+        for price in [10, 20, 40]:
+            Price.objects.create(orig_code=p_30001, dest_code=self.p_10001, day="2023-01-01", price=price)
+        d = {
+            "date_from": "2023-01-03", "date_to": "2023-01-04",
+            "origin": p_30001.code, "destination": self.p_10001.code, "rolling": 3
+        }
+        resp = self.api.get(path="/v1/rates/", data=d)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [{"day": "2023-01-03", "average_price": 23}, {"day": "2023-01-04", "average_price": None}],
+            resp.data["results"]
+        )
+
+        resp = self.api.get(path="/v1/rates/", data=dict(d, rolling=1))
+        self.assertEqual([None, None], [r["average_price"] for r in resp.data["results"]])
+
+    def test_rolling_one_is_daily_average(self):
+        """Test `rolling=1` returns the plain average of the prices of each day"""
+        d = {
+            "date_from": "2023-01-01", "date_to": "2023-01-06",
+            "origin": self.p_20001.code, "destination": self.r1.slug, "rolling": 1
+        }
+        resp = self.api.get(path="/v1/rates/", data=d)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(6, len(resp.data["results"]))
+
+        for idx, day in enumerate([date(2023, 1, 1) + timedelta(days=i) for i in range(6)]):
+            q = Price.objects.filter(
+                orig_code=d["origin"], dest_code__in=self.region1_ports, day=day
+            ).values_list("price", flat=True)
+            if len(q) < 3:
+                self.assertIsNone(resp.data["results"][idx]["average_price"])
+            else:
+                self.assertEqual(pg_round(sum(q), len(q)), resp.data["results"][idx]["average_price"])
+
+
+class LaneFixtureMixin:
+    def setUp(self) -> None:
+        self.r1 = Region.objects.create(slug="region-1", name="region #1", parent=None)
+        self.r11 = Region.objects.create(slug="region-1-1", name="region #1-1", parent=self.r1)
+        self.p_10001 = Port.objects.create(code="10001", name="port-10001", parent=self.r1)
+        self.p_11001 = Port.objects.create(code="11001", name="port-11001", parent=self.r11)
+        self.p_20001 = Port.objects.create(code="20001", name="port-20001", parent=self.r1)
+        self.day = date(2023, 1, 1)
+
+    def add_prices(self, orig, dest, *prices):
+        for price in prices:
+            Price.objects.create(orig_code=orig, dest_code=dest, day=self.day, price=price)
+
+
+class TestLaneSubscription(LaneFixtureMixin, TestCase):
+    """test which daily averages are pushed to the subscribers of `v1/rates/subscribe`"""
+
+    def changes(self, subscription, orig, dest):
+        subscription.notify(orig, dest, self.day)
+        pending, subscription.pending = subscription.pending, set()
+        return subscription.changes(pending)
+
+    def test_invalid_lanes(self):
+        for qs in ["", "lane=10001", "lane=1:20001", "lane=region-1:"]:
+            with self.assertRaises(ValidationError):
+                LaneSubscription.from_qparams(QueryDict(qs))
+        with self.assertRaises(NotFound):
+            LaneSubscription.from_qparams(QueryDict("lane=10001:99999"))
+        with self.assertRaises(NotFound):
+            LaneSubscription.from_qparams(QueryDict("lane=region-9:20001"))
+
+    def test_region_lane_receives_only_changed_averages(self):
+        """the child region ports are part of the lane & unchanged or null averages are not sent again"""
+        subscription = LaneSubscription.from_qparams(QueryDict("lane=region-1:20001&lane=10001:20001"))
+
+        # less than 3 prices: the average is still null, nothing changed
+        self.add_prices(self.p_11001, self.p_20001, 100, 200)
+        self.assertEqual([], self.changes(subscription, "11001", "20001"))
+
+        self.add_prices(self.p_11001, self.p_20001, 300)
+        self.assertEqual(
+            [{"origin": "region-1", "destination": "20001", "day": "2023-01-01", "average_price": 200}],
+            self.changes(subscription, "11001", "20001")
+        )
+
+        # a price which does not change the average of region-1:20001 & leaves 10001:20001 null
+        self.add_prices(self.p_10001, self.p_20001, 200)
+        self.assertEqual([], self.changes(subscription, "10001", "20001"))
+
+        # a lane which is not subscribed is not even queued
+        self.add_prices(self.p_20001, self.p_10001, 1000, 1000, 1000)
+        subscription.notify("20001", "10001", self.day)
+        self.assertEqual(set(), subscription.pending)
+
+    def test_unchanged_average_existing_before_subscription(self):
+        """the first price of a (lane, day) is compared with the average at subscription time"""
+        self.add_prices(self.p_10001, self.p_20001, 100, 200, 300)
+        subscription = LaneSubscription.from_qparams(QueryDict("lane=10001:20001"))
+
+        self.add_prices(self.p_10001, self.p_20001, 200)
+        self.assertEqual([], self.changes(subscription, "10001", "20001"))
+
+        self.add_prices(self.p_10001, self.p_20001, 700)
+        self.assertEqual(
+            [{"origin": "10001", "destination": "20001", "day": "2023-01-01", "average_price": 300}],
+            self.changes(subscription, "10001", "20001")
+        )
+
+    def test_prices_table_without_id(self):
+        """the `prices` table imported from rates.sql has no id column"""
+        insert = "INSERT INTO prices (orig_code, dest_code, day, price) VALUES (%s, %s, %s, %s)"
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE prices DROP COLUMN id")
+            cursor.executemany(insert, [("10001", "20001", self.day, price) for price in [100, 200, 300]])
+        subscription = LaneSubscription.from_qparams(QueryDict("lane=region-1:20001"))
+
+        with connection.cursor() as cursor:
+            cursor.execute(insert, ["11001", "20001", self.day, 200])
+        self.assertEqual([], self.changes(subscription, "11001", "20001"))
+
+        with connection.cursor() as cursor:
+            cursor.execute(insert, ["11001", "20001", self.day, 700])
+        self.assertEqual(
+            [{"origin": "region-1", "destination": "20001", "day": "2023-01-01", "average_price": 300}],
+            self.changes(subscription, "11001", "20001")
+        )
+
+
+class TestSubscribeApp(LaneFixtureMixin, TransactionTestCase):
+    """
+    drive the `v1/rates/subscribe` ASGI app with real inserts; a TransactionTestCase because postgres only delivers
+    the notifications on commit.
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.listener = PriceChangesListener()
+        patcher = mock.patch("rate.subscriptions.listener", self.listener)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def subscribe(self, query_string: bytes):
+        """start the app & return (app task, sent messages queue, disconnect event)"""
+        sent, disconnected = asyncio.Queue(), asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        scope = {"type": "http", "path": "/v1/rates/subscribe/", "query_string": query_string}
+        task = asyncio.ensure_future(subscribe_app(scope, receive, sent.put))
+        return task, sent, disconnected
+
+    async def next_message(self, sent: asyncio.Queue) -> dict:
+        return await asyncio.wait_for(sent.get(), 5)
+
+    async def test_invalid_lane(self):
+        task, sent, _ = await self.subscribe(b"lane=10001:99999")
+        await asyncio.wait_for(task, 5)
+        start = await self.next_message(sent)
+        self.assertEqual(404, start["status"])
+        self.assertIn((b"content-type", b"application/json"), start["headers"])
+        self.assertEqual({"message": "port not found."}, json.loads((await self.next_message(sent))["body"]))
+        self.assertIsNone(self.listener.conn)
+
+    async def test_path_without_trailing_slash(self):
+        """`v1/rates/subscribe` is routed to the subscriptions app, like django's APPEND_SLASH does for the views"""
+        sent = asyncio.Queue()
+        scope = {"type": "http", "path": "/v1/rates/subscribe", "query_string": b"lane=10001"}
+        await asyncio.wait_for(application(scope, None, sent.put), 5)
+        self.assertEqual(400, (await self.next_message(sent))["status"])
+
+    async def test_stream_changed_averages(self):
+        await sync_to_async(self.add_prices)(self.p_11001, self.p_20001, 100, 200, 300)
+        task, sent, disconnected = await self.subscribe(b"lane=region-1:20001")
+        try:
+            start = await self.next_message(sent)
+            self.assertEqual(200, start["status"])
+            self.assertIn((b"content-type", b"text/event-stream"), start["headers"])
+
+            # the first price keeps the average (200), the second one changes it: only the second one is sent
+            await sync_to_async(self.add_prices)(self.p_10001, self.p_20001, 200)
+            await sync_to_async(self.add_prices)(self.p_11001, self.p_20001, 700)
+            message = await self.next_message(sent)
+            self.assertTrue(message["more_body"])
+            event, data = message["body"].decode().strip().split("\n")
+            self.assertEqual("event: rate", event)
+            self.assertEqual(
+                {"origin": "region-1", "destination": "20001", "day": "2023-01-01", "average_price": 300},
+                json.loads(data.removeprefix("data: "))
+            )
+            self.assertTrue(sent.empty())
+
+            disconnected.set()
+            await asyncio.wait_for(task, 5)
+            self.assertEqual(set(), self.listener.subscriptions)
+            # the last subscriber is gone: the LISTEN connection is released
+            self.assertIsNone(self.listener.conn)
+        finally:
+            self.listener.close()
+
+    async def test_lost_listen_connection_ends_streams(self):
+        task, sent, _ = await self.subscribe(b"lane=10001:20001")
+        try:
+            await self.next_message(sent)
+            pid = self.listener.conn.get_backend_pid()
+            await sync_to_async(self.terminate_backend)(pid)
+
+            # the stream ends, so the client reconnects, and the next subscription opens a new connection
+            self.assertEqual({"type": "http.response.body", "body": b""}, await self.next_message(sent))
+            await asyncio.wait_for(task, 5)
+            self.assertIsNone(self.listener.conn)
+            self.assertEqual(set(), self.listener.subscriptions)
+        finally:
+            self.listener.close()
+
+    async def test_lost_database_connection_ends_streams(self):
+        task, sent, _ = await self.subscribe(b"lane=10001:20001")
+        try:
+            await self.next_message(sent)
+            # kill the django connection the streams share & ingest a price through another one
+            await sync_to_async(self.terminate_django_connection_and_insert)()
+
+            self.assertEqual({"type": "http.response.body", "body": b""}, await self.next_message(sent))
+            await asyncio.wait_for(task, 5)
+            # the broken connection was dropped, the next query reconnects
+            self.assertEqual(1, await sync_to_async(Price.objects.count)())
+        finally:
+            self.listener.close()
+
+    def terminate_backend(self, pid: int):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+
+    def terminate_django_connection_and_insert(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        other = psycopg2.connect(**connection.get_connection_params())
+        other.autocommit = True
+        with other.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+            cursor.execute(
+                "INSERT INTO prices (orig_code, dest_code, day, price) VALUES (%s, %s, %s, %s)",
+                ["10001", "20001", self.day, 100]
+            )
+        other.close()